@@ -1,12 +1,11 @@
 from sklearn.svm import SVC
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
+from sklearn.base import clone
+from joblib import Parallel, delayed
 import numpy as np
 from collections import Counter
 
-def most_common(lst):
-    return max(set(lst), key=lst.count)
-
 class CLF:
     """ Implements a classifier for hierarchical clustering
 
@@ -15,13 +14,16 @@ class CLF:
     clf_type : str
         Type of cluster, either 'svm' or 'logreg'
     kwarg : optional arguments for SVM (see SVM definition below for name of keyword arguments)
+    n_jobs : int
+        Number of processes used to train the n_average classifiers (-1 for all cores)
     
     """
 
-    def __init__(self, clf_type='svm', n_average=10, test_size = 0.8, clf_args=None):
+    def __init__(self, clf_type='svm', n_average=10, test_size = 0.8, clf_args=None, n_jobs=1):
         self.clf_type = clf_type
         self.n_average = n_average
         self.test_size = test_size
+        self.n_jobs = n_jobs
 
         self.clf_args = clf_args
 
@@ -43,6 +45,9 @@ class CLF:
         ------------
         self.n_average : int
             number of classifiers to train (will then take majority vote)
+
+        self.n_jobs : int
+            number of processes used for training the classifiers
         
         self.test_size: float
             ratio of test size (between 0 and 1). 
@@ -72,57 +77,19 @@ class CLF:
 
         n_average = self.n_average
     
-        predict_score = []
-        training_score = []
-        clf_list = []
-        xtrain_scaler_list = []
-
-        n_sample = X.shape[0]
-        zero_eps = 1e-6
-
         y_unique = np.unique(y) # different labels
         assert len(y_unique)>1, "Cluster provided only has a unique label, can't classify !"
 
-        n_sample = X.shape[0]
-        idx = np.arange(n_sample)
-        yu_pos = {yu : idx[(y == yu)] for yu in y_unique}
-        n_class = len(y_unique)
-        import time 
-
-        dt=0.0
-
-        import pickle
-
-        for _ in range(n_average):
-            while True:
-                ytrain, ytest, xtrain, xtest = train_test_split(y, X, test_size=self.test_size)
-                if len(np.unique(ytrain)) > 1: # could create a bug otherwise
-                    break
-
-            #print("train size, test size:", len(ytrain),len(ytest),sep='\t')
-            
-            std = np.std(xtrain, axis = 0)    
-            std[std < zero_eps] = 1.0 # get rid of zero variance data.
-            mu, inv_sigma = np.mean(xtrain, axis=0), 1./std
-
-            xtrain = (xtrain - mu)*inv_sigma # zscoring the data 
-            xtest = (xtest - mu)*inv_sigma
-            pickle.dump([xtrain, ytrain], open('test.pkl','wb'))
-            s=time.time()
-            print(len(xtrain))
-            clf.fit(xtrain, ytrain)
-            dt += (time.time() - s)
-
-            t_score = clf.score(xtrain, ytrain) # predict on test set
-            training_score.append(t_score)
-        
-            p_score = clf.score(xtest, ytest) # predict on test set
-            #print(t_score,'\t',p_score)
-            predict_score.append(p_score)
+        # classifiers are independent, can be trained in parallel (seeds drawn here keep np.random.seed reproducible)
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=n_average)
+        results = Parallel(n_jobs=self.n_jobs, backend='loky')(
+            delayed(fit_one)(clone(clf), X, y, self.test_size, seed) for seed in seeds
+        )
 
-            clf_list.append(clf)
-            xtrain_scaler_list.append([mu,inv_sigma])
-        print("TRAINING ONLY\t",dt)
+        clf_list = [r[0] for r in results]
+        xtrain_scaler_list = [[r[1], r[2]] for r in results]
+        training_score = [r[3] for r in results]
+        predict_score = [r[4] for r in results]
 
         self.scaler_list = xtrain_scaler_list # scaling transformations (zero mean, unit std)
         self.cv_score = np.mean(predict_score)
@@ -137,7 +104,7 @@ class CLF:
 
     def predict(self, X, option='fast'):
         """Returns labels for X (-1, 1)"""
-        if option is 'fast':
+        if option == 'fast':
             mu, inv_sigma = self.scaler_list[0]
             return self.clf_list[0].predict(inv_sigma*(X-mu))
 
@@ -149,24 +116,52 @@ class CLF:
 
         # col is clf, row are different data points
         n_clf = len(self.clf_list)
-        vote = []
+        vote = np.empty((len(X), n_clf), dtype=np.result_type(*[clf.classes_ for clf in self.clf_list]))
+        # row are data, col are clf
 
         for i in range(n_clf):
             clf = self.clf_list[i]
             mu, inv_sigma = self.scaler_list[i]
-            xstandard = inv_sigma*(X-mu)
+            xstandard = inv_sigma*(X-mu) # one (n_sample, n_feature) temporary at a time
 
-            vote.append(clf.predict(inv_sigma*(X-mu)))
-
-        vote = np.vstack(vote).T
-        # row are data, col are clf
+            vote[:, i] = clf.predict(xstandard)
     
-        y_pred = []
-        for x_vote in vote: # majority voting here !
-            y_pred.append(most_common(list(x_vote)))
+        # majority voting here ! (on integer codes, so that any label type works)
+        labels, codes = np.unique(vote, return_inverse=True)
+        n_sample, n_label = vote.shape[0], len(labels)
+        codes = codes.reshape(vote.shape) + n_label*np.arange(n_sample)[:, None]
+        count = np.bincount(codes.ravel(), minlength=n_sample*n_label).reshape(n_sample, n_label)
+        y_pred = labels[np.argmax(count, axis=1)] # ties go to the smallest label
 
-        return np.array(y_pred)#.reshape(-1,1)
+        return y_pred#.reshape(-1,1)
 
     def score(self, X, y):
         y_pred = self.predict(X).flatten()
-        return np.count_nonzero(y_pred == y)/len(y)
\ No newline at end of file
+        return np.count_nonzero(y_pred == y)/len(y)
+
+def fit_one(clf, X, y, test_size, seed, zero_eps=1e-6):
+    """ Fits a single classifier on a random train/test split of (X, y)
+
+    Return
+    -------
+    clf, mu, inv_sigma, training score, test score
+    """
+    random_state = np.random.RandomState(seed)
+    while True:
+        ytrain, ytest, xtrain, xtest = train_test_split(y, X, test_size=test_size, random_state=random_state)
+        if len(np.unique(ytrain)) > 1: # could create a bug otherwise
+            break
+
+    std = np.std(xtrain, axis = 0)    
+    std[std < zero_eps] = 1.0 # get rid of zero variance data.
+    mu, inv_sigma = np.mean(xtrain, axis=0), 1./std
+
+    xtrain = (xtrain - mu)*inv_sigma # zscoring the data 
+    xtest = (xtest - mu)*inv_sigma
+
+    clf.fit(xtrain, ytrain)
+
+    t_score = clf.score(xtrain, ytrain) # predict on training set
+    p_score = clf.score(xtest, ytest) # predict on test set
+
+    return clf, mu, inv_sigma, t_score, p_score
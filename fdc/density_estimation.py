@@ -1,6 +1,7 @@
 import numpy as np
 from sklearn.model_selection import train_test_split
-from sklearn.neighbors import KernelDensity, NearestNeighbors
+from sklearn.neighbors import KernelDensity
+from scipy.spatial import cKDTree
 
 class KDE():
     """Kernel density estimation (KDE) for accurate local density estimation.
@@ -47,6 +48,7 @@ class KDE():
 
         if self.bandwidth is None:
             self.bandwidth = self.find_optimal_bandwidth(X)
+            self.kde.bandwidth = self.bandwidth # last evaluated bandwidth is not necessarily the optimal one
         else:
             self.kde=KernelDensity(
                 bandwidth=self.bandwidth, algorithm='kd_tree', 
@@ -80,9 +82,7 @@ class KDE():
         bandwidth estimate, minimum possible value : tuple, shape(2)
         """
         if self.nn_dist is None:
-            nn = NearestNeighbors(n_neighbors=2, algorithm='kd_tree')
-            nn.fit(X_train)
-            nn_dist, _ = nn.kneighbors(X_test, n_neighbors=2, return_distance=True)
+            nn_dist, _ = cKDTree(X_train).query(X_test, k=2, workers=-1)
         else:
             nn_dist = self.nn_dist
 
@@ -141,20 +141,14 @@ class KDE():
         """Fit the kde model on the training set given some bandwidth and evaluates the negative log-likelihood of the test set
         """
         self.kde.bandwidth = bandwidth
+        self.kde.bandwidth_ = bandwidth # scikit-learn >= 1.2 evaluates with the fitted bandwidth_, this avoids refitting the tree
         #l_test = len(X_test)
         return -self.kde.score(X_test[:2000])#X_test[np.random.choice(np.arange(0, l_test), size=min([int(0.5*l_test), 1000]), replace=False)]) # this should be accurate enough !
 
 def round_float(x):
-    """ Rounds a float to it's first significant digit
+    """ Rounds a float to it's first significant digit (set to 1), i.e. its order of magnitude
     """
-    a = list(str(x))
-    for i, e in enumerate(a):
-        if e != '.':
-            if e != '0':
-                pos = i
-                a[i] = '1'
-                break
-    return float("".join(a[:pos+1]))
+    return 10.**np.floor(np.log10(x))
 
 
 
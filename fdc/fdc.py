@@ -16,8 +16,12 @@ import sys, os
 from .density_estimation import KDE
 import pickle
 from collections import OrderedDict as OD
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
+from numba import njit
+from joblib import Parallel, delayed
 import multiprocessing
+
+MIN_PARALLEL_SEARCH = 256 # minimum number of neighborhood searches for which threads are used
     
 class FDC:
 
@@ -132,13 +136,15 @@ class FDC:
         """
         t = time.time()
 
-        self.X = X  # shallow copy
+        # single conversion at entry, cKDTree and KernelDensity both work on C-contiguous float64 arrays
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        self.X = X  # shallow copy only if the input already was C-contiguous float64
         self.n_sample = X.shape[0]
 
         if self.n_sample < 10:
             assert False, "Too few samples for computing densities !"
 
-        if self.nh_size is 'auto':
+        if self.nh_size == 'auto':
             self.nh_size = max([int(25*np.log10(self.n_sample)), 10])
 
         if self.search_size > self.nh_size:
@@ -199,11 +205,13 @@ class FDC:
 
     def fit_density(self, X):
 
-        # nearest neighbors class        
-        self.nbrs = NearestNeighbors(n_neighbors = self.nh_size, algorithm='kd_tree').fit(X)  
+        # nearest neighbors tree (unbalanced, non-compact nodes build faster for low-dimensional data)
+        self.nbrs = cKDTree(X, leafsize=32, balanced_tree=False, compact_nodes=False)
 
-        # get k-NN
-        self.nn_dist, self.nn_list = self.nbrs.kneighbors(X)
+        # get k-NN (batch query over all points, using n_job threads)
+        self.nn_dist, self.nn_list = self.nbrs.query(X, k=self.nh_size, workers=self.n_job)
+        self.nn_list = np.ascontiguousarray(self.nn_list, dtype=np.int32) # halves the memory traffic of the neighbor scans
+        self.nn_dist = np.ascontiguousarray(self.nn_dist, dtype=np.float32)
 
         # density model class
         self.density_model = KDE(bandwidth=self.bandwidth, test_ratio_size=self.test_ratio_size,
@@ -303,7 +311,7 @@ class FDC:
         :delta: distance to n.n. with higher density (within some neighborhood cutoff)
         :nn_delta: index of n.n. with ... 
         :idx_centers: list of points that have the largest density in their neigborhood cutoff
-        :density_graph: for every point, list of points are incoming (via the density gradient)
+        :density_graph: for every point, points that are incoming (via the density gradient), stored as (indptr, children) arrays
 
         """
 
@@ -312,31 +320,27 @@ class FDC:
 
         n_sample, n_feature = X.shape
 
-        maxdist = np.linalg.norm([np.max(X[:,i])-np.min(X[:,i]) for i in range(n_feature)])
-        delta = maxdist*np.ones(n_sample, dtype=np.float)
-        nn_delta = np.ones(n_sample, dtype=np.int)
-        
-        density_graph = [[] for i in range(n_sample)] # store incoming leaves
-        
+        maxdist = float(np.linalg.norm(np.ptp(X, axis=0)))
         ### ----------->
         nn_list = self.nn_list # restricted over neighborhood (nh_size)
         ### ----------->
         
-        for i in range(n_sample):
-            idx = index_greater(rho[nn_list[i]])
-            if idx:
-                density_graph[nn_list[i,idx]].append(i)
-                nn_delta[i] = nn_list[i,idx]
-                delta[i] = self.nn_dist[i,idx]
-            else:
-                nn_delta[i]=-1
+        # first neighbor (in order of distance) with a higher density than the point itself
+        rho_nn = rho[nn_list]
+        is_greater = rho_nn > (rho_nn[:, :1] + 1e-8)
+        has_greater = is_greater.any(axis=1)
+        idx = is_greater.argmax(axis=1)
+        rows = np.arange(n_sample)
+
+        nn_delta = np.where(has_greater, nn_list[rows, idx], -1).astype(np.int32)
+        delta = np.where(has_greater, self.nn_dist[rows, idx], maxdist).astype(np.float64)
         
-        idx_centers=np.array(range(n_sample))[delta > 0.999*maxdist]
+        idx_centers = np.flatnonzero(delta > 0.999*maxdist)
         
         self.delta = delta
         self.nn_delta = nn_delta
         self.idx_centers_unmerged = idx_centers
-        self.density_graph = density_graph
+        self.density_graph = build_density_graph(nn_delta) # store incoming leaves
 
         return self
     
@@ -375,15 +379,29 @@ class FDC:
         if eta is None:
             eta =  self.eta
 
+        if not isinstance(self.density_graph, tuple): # models saved before the graph was stored as (indptr, children)
+            self.density_graph = build_density_graph(self.nn_delta)
+
+        NH_cache = {} # neighborhoods of centers, reused across iterations (same eta)
+        merged = False
+
+        self.cluster_label = assign_cluster(self.idx_centers_unmerged, self.nn_delta, self.density_graph) # first approximation of assignments 
+
         while True: # iterates untill number of cluster does not change ... 
 
-            self.cluster_label = assign_cluster(self.idx_centers_unmerged, self.nn_delta, self.density_graph) # first approximation of assignments 
-            self.idx_centers, n_false_pos = check_cluster_stability(self, X, eta)
+            idx_centers_old = self.idx_centers_unmerged
+            self.idx_centers, n_false_pos = check_cluster_stability(self, X, eta, NH_cache)
             self.idx_centers_unmerged = self.idx_centers
 
             if n_false_pos == 0:
                 print("      # of stable clusters with noise %.6f : %i" % (eta, self.idx_centers.shape[0]))
                 break
+
+            self.cluster_label = relabel_merged(self.cluster_label, idx_centers_old, self.nn_delta)
+            merged = True
+
+        if merged: # the loop only updates nn_delta, the density graph is rebuilt once
+            self.density_graph = build_density_graph(self.nn_delta)
                 
         enablePrint()
 
@@ -408,7 +426,6 @@ class FDC:
         """
         Function for searching for nearest neighbors within some density threshold. 
         NH should be an empty set for the inital function call.
-        Note to myself : lots of optimization, this is pretty time/memory consumming !
         
         Parameters
         -----------
@@ -423,50 +440,7 @@ class FDC:
         -----------
         List of points in the neighborhood of point idx : 1D array
         """
-        rho = self.rho
-
-        zero_array = np.zeros(len(self.nn_list),dtype=bool)
-
-        nn_list = self.nn_list
-        
-        zero_array[nn_list[idx, :self.search_size]] = True
-
-        new_leaves = zero_array
-        
-        is_NH = (rho > eta) & (new_leaves)
-  
-        current_label = cluster_label[idx]
-
-        # This could probably be improved, but at least it's fully vectorized and scalable (NlogN in time and N in memory)
-
-        while True:
-
-            update = False
-            
-            leaves=np.copy(new_leaves)
-            
-            #y_leave = cluster_label[leaves]
-
-            leaves_cluster = (leaves) & (cluster_label == current_label)
-
-            new_leaves=np.zeros(len(self.nn_list), dtype=bool)
-  
-            nn_leaf = np.unique(nn_list[leaves_cluster][:self.search_size].flatten())
-            
-            res = nn_leaf[is_NH[nn_leaf]==False]
-            
-            pos = np.where(rho[res] > eta)[0]
-
-            if len(pos) > 0: update=True
-            
-            is_NH[res[pos]] = True
-
-            new_leaves[res[pos]] = True
-
-            if update is False:
-                break
-
-        return np.where(is_NH)[0]
+        return find_NH_jit(idx, eta, cluster_label, self.rho, self.nn_list, self.search_size)
 
     def find_NH_tree_search_v1(self, idx, eta, cluster_label):
         """
@@ -486,7 +460,7 @@ class FDC:
         
         new_leaves=nn_list[idx][:self.search_size]
         
-        is_NH = np.zeros(len(self.nn_list),dtype=np.int)
+        is_NH = np.zeros(len(self.nn_list),dtype=np.int32)
 
         is_NH[new_leaves[rho[new_leaves] > eta]] = 1
   
@@ -532,7 +506,7 @@ class FDC:
             label_centers_nn = np.unique([cluster_label[ni] for ni in NH]) """
 
     def display_main_parameters(self):
-        if self.eta is not 'auto':
+        if self.eta != 'auto':
             eta = "%.3f"%self.eta
         else:
             eta = self.eta
@@ -555,7 +529,7 @@ class FDC:
 #####################################################
 #####################################################
 
-def check_cluster_stability(self, X, threshold): 
+def check_cluster_stability(self, X, threshold, NH_cache=None): 
     """
     Given the identified cluster centers, performs a more rigourous
     neighborhood search (based on some noise threshold) for points with higher densities.
@@ -563,9 +537,12 @@ def check_cluster_stability(self, X, threshold):
     makes sure we haven't identified spurious cluster centers w.r.t to some noise threshold (false positive).
 
     This has bad memory complexity, needs improvement if we want to run on N>10^5 data points.
+
+    NH_cache (optional dict) stores the neighborhood of every center between calls made with the same threshold.
+    A neighborhood only depends on the members of the center's cluster, which can only grow through mergers,
+    so an entry stays valid as long as the cluster size is unchanged.
     """
 
-    density_graph = self.density_graph
     nn_delta = self.nn_delta
     delta = self.delta
     rho = self.rho
@@ -573,34 +550,45 @@ def check_cluster_stability(self, X, threshold):
     idx_centers = self.idx_centers_unmerged 
     cluster_label = self.cluster_label
 
-    n_false_pos = 0             
-    idx_true_centers = []
+    n_center = idx_centers.shape[0]
+    rho_centers = rho[idx_centers] # density of the center of every cluster label
 
-    for idx in idx_centers:
-        rho_center = rho[idx]
-        delta_rho = rho_center - threshold
-        if threshold < 1e-3: # just check nn_list ...
-            NH=nn_list[idx][1:self.search_size]
+    if threshold < 1e-3: # just check nn_list ... (for all centers at once)
+        label_nh = cluster_label[nn_list[idx_centers, 1:self.search_size]]
+        rho_nh = rho_centers[label_nh]
+        is_max = rho_nh == rho_nh.max(axis=1, keepdims=True)
+        idx_max = idx_centers[np.where(is_max, label_nh, n_center).min(axis=1)] # ties go to the smallest label
+    else:
+        if NH_cache is None:
+            NH_cache = {}
+        cluster_size = np.bincount(cluster_label, minlength=n_center)
+        to_search = [i for i, idx in enumerate(idx_centers) if (idx not in NH_cache) or (NH_cache[idx][0] != cluster_size[i])]
+
+        # searches are independent and the jitted kernel releases the GIL, so threads scale ...
+        # but a single search is fast (<~1ms), starting a thread pool is only worth it for many searches
+        if (self.n_job > 1) & (len(to_search) >= MIN_PARALLEL_SEARCH):
+            NH_list = Parallel(n_jobs=self.n_job, prefer='threads')(
+                delayed(self.find_NH_tree_search)(idx_centers[i], rho_centers[i] - threshold, cluster_label) for i in to_search
+            )
         else:
-            NH = self.find_NH_tree_search(idx, delta_rho, cluster_label)
+            NH_list = [self.find_NH_tree_search(idx_centers[i], rho_centers[i] - threshold, cluster_label) for i in to_search]
+        for i, NH in zip(to_search, NH_list):
+            NH_cache[idx_centers[i]] = (cluster_size[i], NH)
 
-        #print(len(NH))
-        label_centers_nn = np.unique(self.cluster_label[NH])#[cluster_label[ni] for ni in NH])
-        idx_max = idx_centers[ label_centers_nn[np.argmax(rho[idx_centers[label_centers_nn]])] ]
-        rho_current = rho[idx]
+        idx_max = np.empty_like(idx_centers)
+        for i, idx in enumerate(idx_centers):
+            label_nh = cluster_label[NH_cache[idx][1]]
+            rho_nh = rho_centers[label_nh]
+            idx_max[i] = idx_centers[label_nh[rho_nh == rho_nh.max()].min()] # ties go to the smallest label
 
-        if ( rho_current < rho[idx_max] ) & ( idx != idx_max ) : 
+    is_false_pos = ( rho_centers < rho[idx_max] ) & ( idx_centers != idx_max )
+    idx_false_pos, idx_max = idx_centers[is_false_pos], idx_max[is_false_pos]
+    n_false_pos = idx_false_pos.shape[0]
 
-            nn_delta[idx] = idx_max
-            delta[idx] = np.linalg.norm(X[idx_max]-X[idx])
-            density_graph[idx_max].append(idx)
+    nn_delta[idx_false_pos] = idx_max
+    delta[idx_false_pos] = np.linalg.norm(X[idx_max]-X[idx_false_pos], axis=1)
 
-            n_false_pos+=1
-        else:
-            idx_true_centers.append(idx)
-
-        
-    return np.array(idx_true_centers,dtype=np.int), n_false_pos
+    return idx_centers[~is_false_pos].astype(np.int32), n_false_pos
 
 def assign_cluster(idx_centers, nn_delta, density_graph):
     """ 
@@ -608,43 +596,110 @@ def assign_cluster(idx_centers, nn_delta, density_graph):
     point a cluster label
     """
     
-    n_center = idx_centers.shape[0]
     n_sample = nn_delta.shape[0]
-    cluster_label = -1*np.ones(n_sample,dtype=np.int) # reinitialized every time.
-    
-    for c, label in zip(idx_centers, range(n_center) ):
-        cluster_label[c] = label
-        assign_cluster_deep(density_graph[c], cluster_label, density_graph, label)    
-    return cluster_label    
+    indptr, children = density_graph
+    return assign_cluster_jit(np.asarray(idx_centers), indptr, children, n_sample)
 
-def assign_cluster_deep(root,cluster_label,density_graph,label):
+@njit(cache=True)
+def assign_cluster_jit(idx_centers, indptr, children, n_sample):
     """
-    Recursive function for assigning labels for a tree graph.
-    Stopping condition is met when the root is empty (i.e. a leaf has been reached)
+    Iterative depth-first traversal of the density graph (CSR arrays) rooted at every cluster center
     """
-    
-    if not root:  # then must be a leaf !
-        return
-    else:
-        for child in root:
-            cluster_label[child]=label
-            assign_cluster_deep(density_graph[child],cluster_label,density_graph,label)
-        
-def index_greater(array, prec=1e-8):
+    cluster_label = -np.ones(n_sample, np.int32) # reinitialized every time.
+    stack = np.empty(n_sample, np.int32)
+
+    for label in range(idx_centers.shape[0]):
+        top = 0
+        stack[top] = idx_centers[label]
+        top += 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            cluster_label[node] = label
+            for k in range(indptr[node], indptr[node+1]):
+                stack[top] = children[k]
+                top += 1
+    return cluster_label
+
+@njit(cache=True, nogil=True)
+def find_NH_jit(idx, eta, cluster_label, rho, nn_list, search_size):
     """
-    Purpose:
-        Function for finding first item in an array that has a value greater than the first element in that array
-        If no element is found, returns None
-    Precision:
-        1e-8
+    Wave-by-wave search starting from the search_size nearest neighbors of idx. Points with density
+    above eta are added to the neighborhood and form the next wave. In every wave, only the first
+    search_size leaves (in index order) having the same cluster label as idx are expanded, over all their neighbors.
+    """
+    n_sample, nh_size = nn_list.shape
+    is_NH = np.zeros(n_sample, np.bool_)
+    leaves = np.empty(n_sample, np.int32) # each point is a new leaf at most once
+    new_leaves = np.empty(n_sample, np.int32)
+
+    n_leaves = 0
+    for j in range(search_size):
+        leaf = nn_list[idx, j]
+        leaves[n_leaves] = leaf
+        n_leaves += 1
+        if rho[leaf] > eta:
+            is_NH[leaf] = True
+
+    current_label = cluster_label[idx]
+
+    while n_leaves > 0:
+        leaves[:n_leaves] = np.sort(leaves[:n_leaves])
+        n_new = 0
+        n_expanded = 0
+        for i in range(n_leaves):
+            leaf = leaves[i]
+            if cluster_label[leaf] != current_label:
+                continue
+            if n_expanded == search_size:
+                break
+            n_expanded += 1
+            for j in range(nh_size):
+                nn = nn_list[leaf, j]
+                if (not is_NH[nn]) and (rho[nn] > eta):
+                    is_NH[nn] = True
+                    new_leaves[n_new] = nn
+                    n_new += 1
+        leaves, new_leaves = new_leaves, leaves
+        n_leaves = n_new
+
+    return np.nonzero(is_NH)[0]
+
+def relabel_merged(cluster_label, idx_centers, nn_delta):
+    """
+    Updates the cluster labels after some of the centers (idx_centers) have been merged into other clusters (via nn_delta).
+    Equivalent to calling assign_cluster() with the remaining centers, but without traversing the density graph :
+    every merged cluster takes the label of the center it now flows to.
+    """
+    root = np.copy(idx_centers)
+    while True: # follow merged centers until a remaining center is reached
+        is_merged = nn_delta[root] > -1
+        if not is_merged.any():
+            break
+        root[is_merged] = nn_delta[root[is_merged]]
+
+    is_center = nn_delta[idx_centers] == -1
+    new_label = np.cumsum(is_center, dtype=np.int32) - 1 # labels of the remaining centers are their new positions
+    return new_label[cluster_label[root]][cluster_label]
+
+def build_density_graph(nn_delta):
+    """
+    Inverts the local gradients (nn_delta) into a compressed sparse row (CSR) tree graph :
+    the points incoming to point i are children[indptr[i]:indptr[i+1]]
+
     Return:
-        int or None
+        indptr, children : int arrays, shape (n_sample+1,) and (n_edges,)
     """
-    item=array[0]
-    for idx, val in np.ndenumerate(array): # slow ! : could be cythonized
-        if val > (item + prec):
-            return idx[0]
+    n_sample = nn_delta.shape[0]
+    has_parent = nn_delta > -1
+    parents = nn_delta[has_parent]
+
+    indptr = np.zeros(n_sample+1, dtype=np.int32)
+    np.cumsum(np.bincount(parents, minlength=n_sample), out=indptr[1:])
+    children = np.flatnonzero(has_parent)[np.argsort(parents, kind='stable')].astype(np.int32)
 
+    return indptr, children
+        
 def blockPrint():
     """Blocks printing to screen"""
     sys.stdout = open(os.devnull, 'w')
@@ -11,7 +11,7 @@ setup(
       author_email='alexandre.day1@gmail.com',
       license='MIT',
       packages=['fdc'],
-      install_requires =['scikit-learn>=0.19'],
+      install_requires =['scikit-learn>=0.19', 'scipy>=1.6', 'joblib', 'numba'],
       zip_safe=False,
       long_description=long_description,
       long_description_content_type="text/markdown",